@@ -1,11 +1,20 @@
 import cv2
-import numpy as np
 import os
 import argparse
 from pathlib import Path
 
 # --- Image Processing Functions (from your provided code) ---
 
+def multiply_components(reflectance, shading, factor):
+    """
+    Computes clip(reflectance * shading / 255 * factor) in uint16 integer arithmetic.
+    """
+    shading_3ch = cv2.cvtColor(shading, cv2.COLOR_GRAY2BGR)
+    product = cv2.multiply(reflectance, shading_3ch, dtype=cv2.CV_16U)
+    # The product is non-negative, so a negative factor clips to 0; convertScaleAbs would mirror it
+    return cv2.convertScaleAbs(product, alpha=max(factor, 0.0) / 255.0)
+
+
 def reconstruct_from_components_enhance(reflectance_path, shading_path, output_path):
     """
     Reconstructs an original color image from its color reflectance and grayscale shading.
@@ -17,12 +26,7 @@ def reconstruct_from_components_enhance(reflectance_path, shading_path, output_p
         print(f"Error: Could not load components for enhancement. Check paths: {reflectance_path}, {shading_path}")
         return
 
-    reflectance_float = reflectance.astype(np.float32) / 255.0
-    shading_float = shading.astype(np.float32) / 255.0
-    shading_broadcastable = shading_float[..., np.newaxis]
-
-    reconstructed_float = reflectance_float * shading_broadcastable
-    reconstructed_uint8 = np.clip(reconstructed_float * 255, 0, 255).astype(np.uint8)
+    reconstructed_uint8 = multiply_components(reflectance, shading, 1.0)
 
     cv2.imwrite(output_path, reconstructed_uint8)
     print(f"    -> Saved enhanced reconstruction: {Path(output_path).name}")
@@ -38,13 +42,7 @@ def reconstruct_from_components(reflectance_path, shading_path, output_path, dar
         print(f"Error: Could not load components for reconstruction. Check paths: {reflectance_path}, {shading_path}")
         return
 
-    reflectance_float = reflectance.astype(np.float32) / 255.0
-    shading_float = shading.astype(np.float32) / 255.0
-    shading_broadcastable = shading_float[..., np.newaxis]
-
-    reconstructed_float = reflectance_float * shading_broadcastable
-    final_float = reconstructed_float * darkening_factor
-    reconstructed_uint8 = np.clip(final_float * 255, 0, 255).astype(np.uint8)
+    reconstructed_uint8 = multiply_components(reflectance, shading, darkening_factor)
 
     cv2.imwrite(output_path, reconstructed_uint8)
     print(f"    -> Saved darkened reconstruction: {Path(output_path).name}")
@@ -59,10 +57,8 @@ def brighten_image(image_path, output_path, factor=4.0):
         print(f"Error: Could not load original image for brightening at {image_path}")
         return
 
-    image_16bit = np.int16(original_image)
-    brightened_image_16bit = image_16bit * factor
-    brightened_image_clipped = np.clip(brightened_image_16bit, 0, 255)
-    final_image = np.uint8(brightened_image_clipped)
+    # Saturating uint8 scale in a single SIMD pass; a negative factor clips to 0 as the old np.clip did
+    final_image = cv2.convertScaleAbs(original_image, alpha=max(factor, 0.0))
 
     cv2.imwrite(output_path, final_image)
     print(f"    -> Saved brightened image: {Path(output_path).name}")
@@ -19,9 +19,164 @@ Date: 2024
 import cv2
 import numpy as np
 from pathlib import Path
+import os
 import sys
 import argparse
+import threading
+import multiprocessing.util
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from tqdm import tqdm
+from numba import njit, prange, set_num_threads
+
+# Pythran-compiled kernels (see enhance_kernels.py); until the module is built it imports as
+# plain Python and the Numba kernels below are used instead
+import enhance_kernels
+PYTHRAN_KERNELS = not enhance_kernels.__file__.endswith('.py')
+
+# CuPy is optional and only needed for --device cuda
+try:
+    import cupy as cp
+    import cupyx.scipy.ndimage as cp_ndimage
+except ImportError:
+    cp = None
+
+# imread flags for (reflectance, shading) at each supported --decode_scale
+DECODE_FLAGS = {
+    1: (cv2.IMREAD_COLOR, cv2.IMREAD_GRAYSCALE),
+    2: (cv2.IMREAD_REDUCED_COLOR_2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+    4: (cv2.IMREAD_REDUCED_COLOR_4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    8: (cv2.IMREAD_REDUCED_COLOR_8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+}
+
+# Outputs are written with light zlib compression; encoding otherwise dominates per-image time
+PNG_WRITE_PARAMS = [cv2.IMWRITE_PNG_COMPRESSION, 1]
+
+# Background writer so PNG encoding (which releases the GIL) overlaps with computing the next pair.
+# Worker processes swap it for a single thread in `_init_worker`.
+_WRITE_POOL = ThreadPoolExecutor(max_workers=4)
+
+# Output images are double-buffered: one pair's writes can still be reading one slot while the
+# next pair is reconstructed into the other
+_IMAGE_SLOTS = 2
+_PENDING_WRITES = [[] for _ in range(_IMAGE_SLOTS)]
+_next_image_slot = 0
+
+# Sigmas at or above this are blurred with three box filters instead of cv2.GaussianBlur
+BOX_BLUR_MIN_SIGMA = 30
+
+# MSR log-domain maps are int16 Q3.12 fixed point (log value * 4096), half the bytes of float32.
+# log1p(255) * 4096 = 22713 still fits int16, and the fine step keeps MSR within 1/255 of float32.
+_LOG_Q_SCALE = 4096.0
+
+# log1p of every uint8 value in Q3.12; maps a uint8 image to the log domain with a table gather
+_LUT_LOG1P_Q12 = np.round(np.log1p(np.arange(256)) * _LOG_Q_SCALE).astype(np.int16)
+
+# CLAHE objects keyed by (clip_limit, tile_grid), built once per process
+_CLAHE_FILTERS = {}
+
+# Per-thread scratch buffers reused across images, so long runs do not re-allocate (and re-fault)
+# full-size temporaries for every call
+_WS = threading.local()
+
+
+def workspace(name, shape, dtype, zero=False):
+    """
+    Returns this thread's scratch buffer called `name`, allocating it on first use or shape change.
+    
+    Args:
+        name (str): Buffer name, unique per use site
+        shape (tuple): Required shape
+        dtype (np.dtype): Required dtype
+        zero (bool): Zero-fill the buffer; otherwise its contents are undefined
+        
+    Returns:
+        np.ndarray: The cached buffer
+    """
+    buffers = getattr(_WS, 'buffers', None)
+    if buffers is None:
+        buffers = _WS.buffers = {}
+    buf = buffers.get(name)
+    if buf is None or buf.shape != tuple(shape) or buf.dtype != dtype:
+        buf = buffers[name] = np.empty(shape, dtype)
+    if zero:
+        buf.fill(0)
+    return buf
+
+
+# Gamma lookup tables keyed by (gamma, dtype); shading maps are uint8, so a
+# 256-entry table replaces a per-pixel pow().
+_GAMMA_LUTS = {}
+
+
+def gamma_lut(gamma, dtype=np.uint8):
+    """
+    Returns a cached 256-entry lookup table mapping v to 255 * (v / 255) ** gamma.
+    
+    Args:
+        gamma (float): Gamma exponent
+        dtype (np.dtype): Table dtype; uint8 tables are rounded and clipped to 0-255
+        
+    Returns:
+        np.ndarray: Lookup table suitable for `cv2.LUT`
+    """
+    key = (float(gamma), np.dtype(dtype).str)
+    lut = _GAMMA_LUTS.get(key)
+    if lut is None:
+        lut = np.power(np.arange(256) / 255.0, gamma) * 255.0
+        if np.dtype(dtype) == np.uint8:
+            lut = np.clip(np.round(lut), 0, 255)
+        lut = lut.astype(dtype)
+        _GAMMA_LUTS[key] = lut
+    return lut
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def fuse_enhance_shading(shading, base, base_lut, out):
+    """
+    Fused structure-aware recombination and min-max normalization kernel.
+    
+    The log-domain recombination expm1(log1p(E) + log1p(S) - log1p(B)), with E the
+    gamma-enhanced base, reduces to (E + 1) * (S + 1) / (B + 1) - 1. Since B is uint8,
+    (E + 1) / (B + 1) is a 256-entry table, leaving one multiply per pixel. A first
+    pass reduces the min/max, a second pass rescales to 0-255 and writes uint8.
+    
+    Args:
+        shading (np.ndarray): Contiguous uint8 shading map (H, W)
+        base (np.ndarray): Contiguous uint8 base illumination (H, W)
+        base_lut (np.ndarray): float32 table mapping B to its enhanced value E
+        out (np.ndarray): Contiguous uint8 output buffer (H, W)
+    """
+    height, width = shading.shape
+    ratio = np.empty(256, dtype=np.float32)
+    for b in range(256):
+        ratio[b] = (base_lut[b] + 1.0) / (b + 1.0)
+
+    row_min = np.empty(height, dtype=np.float32)
+    row_max = np.empty(height, dtype=np.float32)
+    for i in prange(height):
+        # Seed from the first pixel; fastmath assumes no infinities
+        vmin = ratio[base[i, 0]] * (shading[i, 0] + 1.0) - 1.0
+        vmax = vmin
+        for j in range(1, width):
+            v = ratio[base[i, j]] * (shading[i, j] + 1.0) - 1.0
+            vmin = min(vmin, v)
+            vmax = max(vmax, v)
+        row_min[i] = vmin
+        row_max[i] = vmax
+
+    vmin = row_min.min()
+    vmax = row_max.max()
+    scale = 255.0 / (vmax - vmin) if vmax > vmin else 0.0
+    for i in prange(height):
+        for j in range(width):
+            x = (ratio[base[i, j]] * (shading[i, j] + 1.0) - 1.0 - vmin) * scale
+            if x < 0.0:
+                out[i, j] = 0
+            elif x > 255.0:
+                out[i, j] = 255
+            else:
+                out[i, j] = np.uint8(x)
+
 
 def enhance_shading_map(shading, params):
     """
@@ -32,7 +187,8 @@ def enhance_shading_map(shading, params):
     
     Args:
         shading (np.ndarray): Input shading map (grayscale)
-        params (dict): Enhancement parameters containing 'lambda', 'sigma', 'gamma'
+        params (dict): Enhancement parameters containing 'lambda', 'sigma', 'gamma' and
+            'smoother' ('fgs', 'guided' or 'dt')
         
     Returns:
         np.ndarray: Enhanced shading map
@@ -41,137 +197,167 @@ def enhance_shading_map(shading, params):
     lambda_val = params.get('lambda', 6000.0)
     sigma_color = params.get('sigma', 15.0)
     gamma = params.get('gamma', 1.5)
+    smoother = params.get('smoother', 'fgs')
 
     # 1. Decompose: Extract the large-scale structure (base illumination) using a fast, edge-preserving filter.
     try:
-        base_illumination = cv2.ximgproc.fastGlobalSmootherFilter(shading, shading, lambda_val, sigma_color)
+        if smoother == 'guided':
+            # O(N) box-filter based guided filter
+            base_illumination = cv2.ximgproc.guidedFilter(guide=shading, src=shading, radius=16, eps=1e-3 * 255 * 255)
+        elif smoother == 'dt':
+            # O(N) recursive domain transform filter
+            base_illumination = cv2.ximgproc.dtFilter(shading, shading, sigmaSpatial=60, sigmaColor=sigma_color,
+                                                      mode=cv2.ximgproc.DTF_RF)
+        else:
+            # Global sparse solve; slowest but the reference result
+            base_illumination = cv2.ximgproc.fastGlobalSmootherFilter(shading, shading, lambda_val, sigma_color)
     except AttributeError:
-        print("\nError: `cv2.ximgproc.fastGlobalSmootherFilter` not found.")
+        print("\nError: `cv2.ximgproc` edge-preserving filters not found.")
         print("Please ensure you have the full OpenCV package installed: `pip install opencv-contrib-python`")
         sys.exit(1)
 
-    # Work in the log domain for better separation and recombination
-    shading_log = np.log1p(shading.astype(np.float32))
-    base_log = np.log1p(base_illumination.astype(np.float32))
+    # 2-5. Enhance only the base layer with gamma, recombine it with the original
+    # detail layer (log-domain ratio shading / base) and normalize to 0-255, fused
+    # into a single kernel
+    if PYTHRAN_KERNELS:
+        return enhance_kernels.enhance_shading_kernel(shading, base_illumination, gamma_lut(gamma, np.float32))
+    enhanced_shading = np.empty_like(shading)
+    fuse_enhance_shading(shading, base_illumination, gamma_lut(gamma, np.float32), enhanced_shading)
     
-    # 2. Calculate the detail layer
-    detail_log = shading_log - base_log
+    return enhanced_shading
 
-    # 3. Enhance only the base illumination layer
-    base_float = base_illumination.astype(np.float32) / 255.0
-    enhanced_base_float = np.power(base_float, gamma)
-    enhanced_base_log = np.log1p(enhanced_base_float * 255.0)
 
-    # 4. Recombine the enhanced base with the original detail layer
-    final_shading_log = enhanced_base_log + detail_log
-    final_shading = np.expm1(final_shading_log)
+def reconstruct(reflectance, shading, brightness_factor):
+    """
+    Multiplies a reflectance map by a (possibly enhanced) shading map and applies a brightness factor.
     
-    # 5. Normalize the result to the full 0-255 range for consistency
-    enhanced_shading_norm = cv2.normalize(final_shading, None, 0, 255, cv2.NORM_MINMAX)
+    Stays in integer arithmetic: the uint8 x uint8 product fits exactly in uint16, and a single
+    saturating scale by brightness / 255 brings it back to uint8.
     
-    return enhanced_shading_norm.astype(np.uint8)
+    Args:
+        reflectance (np.ndarray): uint8 reflectance map (H, W, 3)
+        shading (np.ndarray): uint8 shading map (H, W)
+        brightness_factor (float): Brightness factor applied to the result
+        
+    Returns:
+        np.ndarray: Reconstructed uint8 image (H, W, 3)
+    """
+    shading_3ch = cv2.cvtColor(shading, cv2.COLOR_GRAY2BGR, dst=workspace('reconstruct_shading', reflectance.shape, np.uint8))
+    product = cv2.multiply(reflectance, shading_3ch, dst=workspace('reconstruct_product', reflectance.shape, np.uint16),
+                           dtype=cv2.CV_16U)
+    # The product is non-negative, so a negative factor clips to 0; convertScaleAbs would mirror it
+    return cv2.convertScaleAbs(product, alpha=max(brightness_factor, 0.0) / 255.0)
 
 
-def reconstruct_from_components_structured(reflectance_path, shading_path, params, brightness_factor=1.0):
+@njit(parallel=True, fastmath=True, cache=True)
+def fuse_reconstruct_batched(reflectance, shadings, brightness, out):
+    """
+    Batched `reconstruct`: multiplies one reflectance map by N shading maps in a single pass.
+    
+    Each reflectance row stays in cache while all N variants of it are produced, so the
+    large (H, W, 3) buffer is read from memory once instead of N times. The arithmetic mirrors
+    `reconstruct` exactly: the exact uint16 product is scaled in float32 and rounded
+    half to even, as cv2.convertScaleAbs does.
+    
+    Args:
+        reflectance (np.ndarray): Contiguous uint8 reflectance map (H, W, 3)
+        shadings (np.ndarray): Contiguous uint8 stack of shading maps (N, H, W)
+        brightness (float): Brightness factor applied to every result
+        out (np.ndarray): Contiguous uint8 output stack (N, H, W, 3)
+    """
+    n_variants, height, width = shadings.shape
+    scale = np.float32(max(brightness, 0.0) / 255.0)
+    for i in prange(height):
+        for k in range(n_variants):
+            for j in range(width):
+                s = np.uint16(shadings[k, i, j])
+                for c in range(3):
+                    x = np.rint(np.float32(np.uint16(reflectance[i, j, c]) * s) * scale)
+                    out[k, i, j, c] = np.uint8(min(x, np.float32(255.0)))
+
+
+def reconstruct_from_components_structured(reflectance, shading, params, brightness_factor=1.0):
     """
     Reconstructs an image using the STRUCTURE-AWARE ENHANCED shading map and applies a brightness factor.
     """
-    reflectance = cv2.imread(str(reflectance_path), cv2.IMREAD_COLOR)
-    shading = cv2.imread(str(shading_path), cv2.IMREAD_GRAYSCALE)
-    if reflectance is None or shading is None:
-        print(f"Warning: Could not read {reflectance_path} or {shading_path}")
-        return None
-
     # Apply the structure-aware enhancement to the shading map
     enhanced_shading = enhance_shading_map(shading, params)
     
-    reflectance_float = reflectance.astype(np.float32) / 255.0
-    shading_float = enhanced_shading.astype(np.float32) / 255.0
-    
-    shading_broadcastable = shading_float[..., np.newaxis]
-    reconstructed_float = reflectance_float * shading_broadcastable
-    
-    # Apply the final brightness factor
-    brightened_float = reconstructed_float * brightness_factor
-    
-    return np.clip(brightened_float * 255, 0, 255).astype(np.uint8)
+    return reconstruct(reflectance, enhanced_shading, brightness_factor)
 
 
-def reconstruct_with_gamma_correction(reflectance_path, shading_path, gamma, brightness_factor=1.0):
+def reconstruct_with_gamma_correction(reflectance, shading, gamma, brightness_factor=1.0):
     """
     Reconstructs an image by applying a simple gamma correction to the ORIGINAL shading map.
     """
-    reflectance = cv2.imread(str(reflectance_path), cv2.IMREAD_COLOR)
-    shading = cv2.imread(str(shading_path), cv2.IMREAD_GRAYSCALE)
-
-    if reflectance is None or shading is None:
-        print(f"Error: Could not load components. Check paths: {reflectance_path}, {shading_path}")
-        return None
-
     # Apply simple gamma correction to the shading map
-    shading_float = shading.astype(np.float32) / 255.0
-    enhanced_shading_float = np.power(shading_float, gamma)
-    
-    reflectance_float = reflectance.astype(np.float32) / 255.0
-    shading_broadcastable = enhanced_shading_float[..., np.newaxis]
-    
-    reconstructed_float = reflectance_float * shading_broadcastable
+    enhanced_shading = cv2.LUT(shading, gamma_lut(gamma))
     
-    # Apply the final brightness factor
-    brightened_float = reconstructed_float * brightness_factor
-    
-    return np.clip(brightened_float * 255, 0, 255).astype(np.uint8)
+    return reconstruct(reflectance, enhanced_shading, brightness_factor)
 
 
-def reconstruct_from_components_simple(reflectance_path, shading_path, brightness_factor=1.0):
+def reconstruct_from_components_simple(reflectance, shading, brightness_factor=1.0):
     """
     Reconstructs an image using the ORIGINAL shading map with no enhancement.
     """
-    reflectance = cv2.imread(str(reflectance_path), cv2.IMREAD_COLOR)
-    shading = cv2.imread(str(shading_path), cv2.IMREAD_GRAYSCALE)
-    if reflectance is None or shading is None:
-        print(f"Warning: Could not read {reflectance_path} or {shading_path}")
-        return None
-
-    reflectance_float = reflectance.astype(np.float32) / 255.0
-    shading_float = shading.astype(np.float32) / 255.0
-    
-    shading_broadcastable = shading_float[..., np.newaxis]
-    reconstructed_float = reflectance_float * shading_broadcastable
-    
-    # Apply the final brightness factor
-    brightened_float = reconstructed_float * brightness_factor
-    
-    return np.clip(brightened_float * 255, 0, 255).astype(np.uint8)
+    return reconstruct(reflectance, shading, brightness_factor)
 
 
-def reconstruct_with_clahe_enhancement(reflectance_path, shading_path, clahe_params, brightness_factor=1.0):
+def clahe_filter(clahe_params):
     """
-    Reconstructs an image by applying CLAHE to the ORIGINAL shading map.
+    Returns a cached CLAHE (Contrast Limited Adaptive Histogram Equalization) object for `clahe_params`.
+    
+    CLAHE objects cannot be pickled to worker processes, so each process builds one per
+    parameter set on first use and reuses it for every image.
     """
-    reflectance = cv2.imread(str(reflectance_path), cv2.IMREAD_COLOR)
-    shading = cv2.imread(str(shading_path), cv2.IMREAD_GRAYSCALE)
+    key = (float(clahe_params['clip_limit']), tuple(clahe_params['tile_grid']))
+    clahe = _CLAHE_FILTERS.get(key)
+    if clahe is None:
+        clahe = _CLAHE_FILTERS[key] = cv2.createCLAHE(clipLimit=key[0], tileGridSize=key[1])
+    return clahe
 
-    if reflectance is None or shading is None:
-        print(f"Error: Could not load components. Check paths: {reflectance_path}, {shading_path}")
-        return None
 
-    # Create a CLAHE object (Contrast Limited Adaptive Histogram Equalization)
-    clahe = cv2.createCLAHE(clipLimit=clahe_params['clip_limit'], tileGridSize=clahe_params['tile_grid'])
+def reconstruct_with_clahe_enhancement(reflectance, shading, clahe, brightness_factor=1.0):
+    """
+    Reconstructs an image by applying CLAHE to the ORIGINAL shading map.
     
+    `clahe` is a `cv2.CLAHE` object, e.g. from `clahe_filter`, shared across images.
+    """
     # Apply CLAHE to the shading map to enhance local contrast
     enhanced_shading = clahe.apply(shading)
 
-    reflectance_float = reflectance.astype(np.float32) / 255.0
-    shading_float = enhanced_shading.astype(np.float32) / 255.0
-    
-    shading_broadcastable = shading_float[..., np.newaxis]
-    reconstructed_float = reflectance_float * shading_broadcastable
+    return reconstruct(reflectance, enhanced_shading, brightness_factor)
+
+
+def gaussian_blur(src, sigma, dst):
+    """
+    Gaussian-blurs `src` into `dst`, switching to an iterated box filter for large sigmas.
     
-    # Apply the final brightness factor
-    brightened_float = reconstructed_float * brightness_factor
+    Three successive box filters approximate a Gaussian in time independent of the
+    kernel size, which keeps the large MSR scales (e.g. sigma=250) cheap.
     
-    return np.clip(brightened_float * 255, 0, 255).astype(np.uint8)
+    Args:
+        src (np.ndarray): Input float32 or int16 map
+        sigma (float): Gaussian standard deviation
+        dst (np.ndarray): Output buffer with the same shape and dtype as `src`
+        
+    Returns:
+        np.ndarray: `dst`
+    """
+    if sigma < BOX_BLUR_MIN_SIGMA:
+        # Kernel size must be odd
+        k_size = int(6 * sigma + 1)
+        if k_size % 2 == 0:
+            k_size += 1
+        return cv2.GaussianBlur(src, (k_size, k_size), sigma, dst=dst)
+
+    # Box width whose three-pass variance matches sigma^2
+    radius = int(np.sqrt(12 * sigma * sigma / 3 + 1) // 2)
+    k_size = 2 * radius + 1
+    cv2.boxFilter(src, -1, (k_size, k_size), dst=dst)
+    cv2.boxFilter(dst, -1, (k_size, k_size), dst=dst)
+    cv2.boxFilter(dst, -1, (k_size, k_size), dst=dst)
+    return dst
 
 
 def multi_scale_retinex(shading, sigmas):
@@ -189,53 +375,250 @@ def multi_scale_retinex(shading, sigmas):
     Returns:
         np.ndarray: MSR enhanced shading map
     """
-    shading_log = np.log1p(shading.astype(np.float32))
-    retinex = np.zeros_like(shading_log)
+    # Log-domain maps are int16 Q3.12; the sum of blurs is int32 so many scales cannot overflow
+    shading_log = cv2.LUT(shading, _LUT_LOG1P_Q12, dst=workspace('msr_shading_log', shading.shape, np.int16))
+    sum_blur = workspace('msr_sum_blur', shading.shape, np.int32, zero=True)
+    blurred_log = workspace('msr_blurred_log', shading.shape, np.int16)
 
     for sigma in sigmas:
-        # Kernel size must be odd
-        k_size = int(6 * sigma + 1)
-        if k_size % 2 == 0:
-            k_size += 1
-        
-        blurred_log = cv2.GaussianBlur(shading_log, (k_size, k_size), sigma)
-        retinex += shading_log - blurred_log
+        gaussian_blur(shading_log, sigma, blurred_log)
+        cv2.add(sum_blur, blurred_log, dst=sum_blur, dtype=cv2.CV_32S)
     
-    retinex /= len(sigmas)
-    enhanced_shading = np.expm1(retinex)
+    # mean(shading_log - blurred_log) == shading_log - sum_blur / N, a single pass that
+    # also converts from Q3.12 back to a float32 log map
+    retinex = cv2.addWeighted(shading_log, 1.0 / _LOG_Q_SCALE, sum_blur, -1.0 / (_LOG_Q_SCALE * len(sigmas)), 0,
+                              dst=workspace('msr_retinex', shading.shape, np.float32), dtype=cv2.CV_32F)
+    # SIMD exp in place; the -1 of expm1 is a constant offset that the min-max normalization removes
+    enhanced_shading = cv2.exp(retinex, dst=retinex)
     
-    # Normalize to full 0-255 range
-    return cv2.normalize(enhanced_shading, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+    # Normalize to full 0-255 range, rescaling and casting to uint8 in one pass
+    min_val, max_val, _, _ = cv2.minMaxLoc(enhanced_shading)
+    scale = 255.0 / max(max_val - min_val, 1e-6)
+    return cv2.convertScaleAbs(enhanced_shading, alpha=scale, beta=-min_val * scale)
 
 
-def reconstruct_with_msr_enhancement(reflectance_path, shading_path, msr_sigmas, brightness_factor=1.0):
+def reconstruct_with_msr_enhancement(reflectance, shading, msr_sigmas, brightness_factor=1.0):
     """
     Reconstructs an image using a Multi-Scale Retinex enhanced shading map.
     This is a state-of-the-art method for superior low-light enhancement.
     """
-    reflectance = cv2.imread(str(reflectance_path), cv2.IMREAD_COLOR)
-    shading = cv2.imread(str(shading_path), cv2.IMREAD_GRAYSCALE)
+    # Apply Multi-Scale Retinex to the shading map
+    enhanced_shading = multi_scale_retinex(shading, msr_sigmas)
+
+    return reconstruct(reflectance, enhanced_shading, brightness_factor)
 
+
+# File-name suffix of each output type, keyed like the maps returned by `shading_variants`
+VARIANT_SUFFIXES = {
+    'msr': '_msr_enhanced',
+    'enhanced': '_enhanced',
+    'gamma': '_gamma_enhanced',
+    'clahe': '_clahe_enhanced',
+    'reconstructed': '_reconstructed',
+}
+
+
+def shading_variants(shading, params, simple_gamma, clahe_params, msr_sigmas, msr_shading=None):
+    """
+    Computes the five shading maps that `run_inference` reconstructs for each image pair.
+    
+    Each map goes through the same shading step as its `reconstruct_*` function, so the
+    CLI writes the same images as the API.
+    
+    Args:
+        shading (np.ndarray): uint8 shading map (H, W)
+        params (dict): Structure-aware enhancement parameters, see `enhance_shading_map`
+        simple_gamma (float): Gamma for the simple gamma correction
+        clahe_params (dict): CLAHE parameters with 'clip_limit' and 'tile_grid'
+        msr_sigmas (list): Sigma values for Multi-Scale Retinex
+        msr_shading (array, optional): Precomputed MSR map (e.g. from the GPU); computed with
+            `multi_scale_retinex` if None
+        
+    Returns:
+        dict: Shading maps keyed like `VARIANT_SUFFIXES`
+    """
+    return {
+        'msr': multi_scale_retinex(shading, msr_sigmas) if msr_shading is None else msr_shading,
+        'enhanced': enhance_shading_map(shading, params),
+        'gamma': cv2.LUT(shading, gamma_lut(simple_gamma)),
+        'clahe': clahe_filter(clahe_params).apply(shading),
+        'reconstructed': shading,
+    }
+
+
+def _read_pair(r_path, s_path, decode_scale=1):
+    """
+    Decodes a reflectance/shading pair, or warns and returns None if it cannot be processed.
+    
+    Both maps must share the same size: the batched CPU kernel does no bounds checking,
+    and the GPU kernel cannot broadcast mismatched shapes.
+    """
+    reflectance_flag, shading_flag = DECODE_FLAGS[decode_scale]
+    reflectance = cv2.imread(str(r_path), reflectance_flag)
+    shading = cv2.imread(str(s_path), shading_flag)
     if reflectance is None or shading is None:
-        print(f"Error: Could not load components. Check paths: {reflectance_path}, {shading_path}")
+        print(f"Warning: Could not read {r_path} or {s_path}, skipping.")
+        return None
+    if shading.shape != reflectance.shape[:2]:
+        print(f"Warning: Size mismatch between {r_path} and {s_path}, skipping.")
         return None
+    return reflectance, shading
 
-    # Apply Multi-Scale Retinex to the shading map
-    enhanced_shading = multi_scale_retinex(shading, msr_sigmas)
 
-    reflectance_float = reflectance.astype(np.float32) / 255.0
-    shading_float = enhanced_shading.astype(np.float32) / 255.0
-    
-    shading_broadcastable = shading_float[..., np.newaxis]
-    reconstructed_float = reflectance_float * shading_broadcastable
+# --- GPU (CuPy) pipeline, used with --device cuda ---
+
+if cp is not None:
+    # CUDA counterpart of `reconstruct`; shading is broadcast over the colour channels. The exact
+    # integer product is scaled in float32 and rounded half to even, as cv2.convertScaleAbs does
+    _cuda_fuse_reconstruct = cp.ElementwiseKernel(
+        'uint8 r, uint8 s, float32 scale',
+        'uint8 out',
+        'float x = rintf((float)(r * s) * scale); out = x < 0.0f ? 0 : (x > 255.0f ? 255 : (unsigned char)x)',
+        'cuda_fuse_reconstruct'
+    )
+
+
+def reconstruct_cuda(reflectance_gpu, shading_gpu, brightness_factor):
+    """
+    GPU version of `reconstruct` for uint8 CuPy arrays already resident on the device.
+    """
+    scale = np.float32(brightness_factor / 255.0)
+    return _cuda_fuse_reconstruct(reflectance_gpu, shading_gpu[..., np.newaxis], scale)
+
+
+def multi_scale_retinex_cuda(shading_gpu, sigmas):
+    """
+    GPU version of `multi_scale_retinex` operating on a uint8 CuPy shading map.
     
-    # Apply the final brightness factor
-    brightened_float = reconstructed_float * brightness_factor
+    Uses the same Gaussian / three-box-filter split, exp and min-max normalization as the
+    CPU path, but in float32 with cupyx filters rather than int16 Q3.12 with OpenCV ones,
+    so its output is not bit-identical to the CPU MSR. This path has not yet been run on
+    GPU hardware.
+    """
+    shading_log = cp.log1p(shading_gpu.astype(cp.float32))
+    sum_blur = cp.zeros_like(shading_log)
+
+    for sigma in sigmas:
+        if sigma < BOX_BLUR_MIN_SIGMA:
+            # 'mirror' is OpenCV's BORDER_REFLECT_101; truncate=3 matches the 6*sigma+1 kernel
+            blurred_log = cp_ndimage.gaussian_filter(shading_log, sigma, mode='mirror', truncate=3.0)
+        else:
+            radius = int(np.sqrt(12 * sigma * sigma / 3 + 1) // 2)
+            k_size = 2 * radius + 1
+            blurred_log = shading_log
+            for _ in range(3):
+                blurred_log = cp_ndimage.uniform_filter(blurred_log, k_size, mode='mirror')
+        sum_blur += blurred_log
+
+    # exp rather than expm1, as on the CPU; the -1 is removed by the min-max normalization
+    enhanced_shading = cp.exp(shading_log - sum_blur / len(sigmas))
+
+    # Normalize to full 0-255 range
+    min_val = enhanced_shading.min()
+    scale = 255.0 / cp.maximum(enhanced_shading.max() - min_val, 1e-6)
+    return cp.clip(cp.rint((enhanced_shading - min_val) * scale), 0, 255).astype(cp.uint8)
+
+
+def _process_one_cuda(r_path, s_path, base_name, output_dirs, params, brightness_factor, simple_gamma, clahe_params,
+                      msr_sigmas, decode_scale=1):
+    """
+    GPU version of `_process_one`: uploads the pair once and runs MSR and all five reconstructions on the device.
     
-    return np.clip(brightened_float * 255, 0, 255).astype(np.uint8)
+    The structured, gamma and CLAHE shading maps rely on CPU-only OpenCV filters, so they are
+    computed on the host and uploaded as uint8.
+    """
+    pair = _read_pair(r_path, s_path, decode_scale)
+    if pair is None:
+        return
+    reflectance, shading = pair
+
+    reflectance_gpu = cp.asarray(reflectance)
+    shading_gpu = cp.asarray(shading)
+
+    variants = shading_variants(shading, params, simple_gamma, clahe_params, msr_sigmas,
+                                msr_shading=multi_scale_retinex_cuda(shading_gpu, msr_sigmas))
+
+    # Bounds the number of pairs held in host memory while their writes are pending
+    slot = _claim_image_slot()
+    for key, enhanced_shading in variants.items():
+        # cp.asarray uploads the host-computed maps and passes device arrays through
+        image = reconstruct_cuda(reflectance_gpu, cp.asarray(enhanced_shading), brightness_factor).get()
+        file_path = output_dirs[key] / f"{base_name}{VARIANT_SUFFIXES[key]}.png"
+        _PENDING_WRITES[slot].append(_WRITE_POOL.submit(cv2.imwrite, str(file_path), image, PNG_WRITE_PARAMS))
 
 
-def run_inference(input_dir, output_dir, params, brightness_factor, simple_gamma, clahe_params, msr_sigmas):
+def _wait_for_writes(slot):
+    """
+    Blocks until the PNG writes reading from output slot `slot` have finished.
+    """
+    for write in _PENDING_WRITES[slot]:
+        write.result()
+    _PENDING_WRITES[slot] = []
+
+
+def _claim_image_slot():
+    """
+    Returns the next output slot, once the writes of the pair that last used it are done.
+    """
+    global _next_image_slot
+    slot = _next_image_slot
+    _next_image_slot = (slot + 1) % _IMAGE_SLOTS
+    _wait_for_writes(slot)
+    return slot
+
+
+def _drain_writes():
+    """
+    Blocks until every pending PNG write has finished.
+    """
+    for slot in range(_IMAGE_SLOTS):
+        _wait_for_writes(slot)
+
+
+def _init_worker():
+    """
+    Limits each worker process to a single OpenCV/Numba thread to avoid oversubscribing the CPU.
+    """
+    global _WRITE_POOL
+    cv2.setNumThreads(1)
+    set_num_threads(1)
+    # One encode thread per worker, overlapping its next pair without multiplying the thread count
+    _WRITE_POOL = ThreadPoolExecutor(max_workers=1)
+    # The last pair's writes are still pending when the pool shuts the worker down
+    multiprocessing.util.Finalize(None, _drain_writes, exitpriority=10)
+
+
+def _process_one(r_path, s_path, base_name, output_dirs, params, brightness_factor, simple_gamma, clahe_params, msr_sigmas,
+                 decode_scale=1):
+    """
+    Decodes one reflectance/shading pair and writes all five enhanced versions of it.
+    """
+    # Decode each pair once; all five variants share the same uint8 buffers
+    pair = _read_pair(r_path, s_path, decode_scale)
+    if pair is None:
+        return
+    reflectance, shading = pair
+
+    # Build the five shading variants into one (5, H, W) stack
+    variants = shading_variants(shading, params, simple_gamma, clahe_params, msr_sigmas)
+    shadings = workspace('variant_shadings', (len(variants),) + shading.shape, np.uint8)
+    for k, enhanced_shading in enumerate(variants.values()):
+        shadings[k] = enhanced_shading
+
+    # Reconstruct all five in one pass over the reflectance map, into a slot the previous
+    # pair's writes are not still reading
+    slot = _claim_image_slot()
+    images = workspace(f'variant_images_{slot}', (len(variants),) + reflectance.shape, np.uint8)
+    fuse_reconstruct_batched(reflectance, shadings, brightness_factor, images)
+
+    # Returns without waiting; the writes finish while the next pair is computed
+    for k, key in enumerate(variants):
+        file_path = output_dirs[key] / f"{base_name}{VARIANT_SUFFIXES[key]}.png"
+        _PENDING_WRITES[slot].append(_WRITE_POOL.submit(cv2.imwrite, str(file_path), images[k], PNG_WRITE_PARAMS))
+
+
+def run_inference(input_dir, output_dir, params, brightness_factor, simple_gamma, clahe_params, msr_sigmas, decode_scale=1,
+                  device='cpu'):
     """
     Processes all images, creating five versions including the new MSR method.
     """
@@ -262,57 +645,63 @@ def run_inference(input_dir, output_dir, params, brightness_factor, simple_gamma
     print(f"  - Gamma Enhanced:      {gamma_enhanced_dir}")
     print(f"  - CLAHE Enhanced:      {clahe_enhanced_dir}")
     print(f"  - Reconstructed:       {reconstructed_dir}")
-    print(f"Structured Params: λ={params['lambda']}, γ={params['gamma']}, σ={params['sigma']}")
+    print(f"Structured Params: λ={params['lambda']}, γ={params['gamma']}, σ={params['sigma']}, smoother={params['smoother']}")
     print(f"Simple Gamma Param: γ={simple_gamma}")
     print(f"CLAHE Params: Clip Limit={clahe_params['clip_limit']}, Tile Size={clahe_params['tile_grid']}")
     print(f"MSR Sigmas: {msr_sigmas}")
     print(f"Brightness Factor: {brightness_factor}")
+    print(f"Decode Scale: 1/{decode_scale}")
+    print(f"Device: {device}")
 
-    reflectance_files = sorted(list(input_path.glob('*-r.png')))
+    # Scan the directory once; shading files are then matched by name lookup instead of a stat per pair
+    with os.scandir(input_path) as entries:
+        file_names = {entry.name for entry in entries if entry.is_file()}
+    reflectance_names = sorted(name for name in file_names if name.endswith('-r.png'))
     
-    if not reflectance_files:
+    if not reflectance_names:
         print(f"Error: No reflectance files ('*-r.png') found in '{input_dir}'.")
         sys.exit(1)
 
-    print(f"\nFound {len(reflectance_files)} image pairs to process.")
+    print(f"\nFound {len(reflectance_names)} image pairs to process.")
     
-    for r_path in tqdm(reflectance_files, desc="Processing images", ncols=100):
-        base_name = r_path.stem.removesuffix('-r')
-        s_path = input_path / f"{base_name}-s.png"
+    # Pair up the inputs up front so the workers only receive existing files
+    pairs = []
+    for r_name in reflectance_names:
+        base_name = r_name.removesuffix('-r.png')
+        s_name = f"{base_name}-s.png"
         
-        if not s_path.exists():
-            print(f"Warning: Shading file not found for {r_path.name}, skipping.")
+        if s_name not in file_names:
+            print(f"Warning: Shading file not found for {r_name}, skipping.")
             continue
-            
-        # 1. Generate and save the new MSR-ENHANCED image
-        msr_image = reconstruct_with_msr_enhancement(r_path, s_path, msr_sigmas, brightness_factor)
-        if msr_image is not None:
-            msr_save_path = msr_enhanced_dir / f"{base_name}_msr_enhanced.png"
-            cv2.imwrite(str(msr_save_path), msr_image)
-
-        # 2. Generate and save the STRUCTURE-AWARE ENHANCED image
-        enhanced_image = reconstruct_from_components_structured(r_path, s_path, params, brightness_factor=brightness_factor)
-        if enhanced_image is not None:
-            enhanced_save_path = enhanced_dir / f"{base_name}_enhanced.png"
-            cv2.imwrite(str(enhanced_save_path), enhanced_image)
-
-        # 3. Generate and save the simple GAMMA-ENHANCED image
-        gamma_enhanced_image = reconstruct_with_gamma_correction(r_path, s_path, simple_gamma, brightness_factor)
-        if gamma_enhanced_image is not None:
-            gamma_save_path = gamma_enhanced_dir / f"{base_name}_gamma_enhanced.png"
-            cv2.imwrite(str(gamma_save_path), gamma_enhanced_image)
-
-        # 4. Generate and save the CLAHE-ENHANCED image
-        clahe_image = reconstruct_with_clahe_enhancement(r_path, s_path, clahe_params, brightness_factor)
-        if clahe_image is not None:
-            clahe_save_path = clahe_enhanced_dir / f"{base_name}_clahe_enhanced.png"
-            cv2.imwrite(str(clahe_save_path), clahe_image)
-
-        # 5. Generate and save the simple RECONSTRUCTED image
-        reconstructed_image = reconstruct_from_components_simple(r_path, s_path, brightness_factor=brightness_factor)
-        if reconstructed_image is not None:
-            reconstructed_save_path = reconstructed_dir / f"{base_name}_reconstructed.png"
-            cv2.imwrite(str(reconstructed_save_path), reconstructed_image)
+        pairs.append((input_path / r_name, input_path / s_name, base_name))
+
+    output_dirs = {
+        'msr': msr_enhanced_dir,
+        'enhanced': enhanced_dir,
+        'gamma': gamma_enhanced_dir,
+        'clahe': clahe_enhanced_dir,
+        'reconstructed': reconstructed_dir,
+    }
+
+    if device == 'cuda':
+        # A single process owns the GPU, so pairs are processed serially with the pixel work on the device
+        for r_path, s_path, base_name in tqdm(pairs, desc="Processing images", ncols=100):
+            _process_one_cuda(r_path, s_path, base_name, output_dirs,
+                              params, brightness_factor, simple_gamma, clahe_params, msr_sigmas, decode_scale)
+        _drain_writes()
+    else:
+        # Image pairs are independent, so process them in parallel worker processes
+        with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=_init_worker) as executor:
+            futures = [
+                executor.submit(_process_one, r_path, s_path, base_name, output_dirs,
+                                params, brightness_factor, simple_gamma, clahe_params, msr_sigmas, decode_scale)
+                for r_path, s_path, base_name in pairs
+            ]
+            with tqdm(total=len(futures), desc="Processing images", ncols=100) as progress:
+                for future in as_completed(futures):
+                    future.result()
+                    progress.update(1)
+        # Leaving the `with` block joins the workers, and each drains its pending writes before exiting
 
     print("\n--- Inference Complete ---")
     print(f"✅ MSR enhanced images saved to '{msr_enhanced_dir}'")
@@ -364,6 +753,14 @@ if __name__ == "__main__":
         default=15.0, 
         help="Sigma color for the structured enhancement filter. Default is 15.0."
     )
+    parser.add_argument(
+        '--smoother',
+        type=str,
+        choices=['fgs', 'guided', 'dt'],
+        default='fgs',
+        help="Edge-preserving filter for the structured enhancement: 'fgs' (fast global smoother), "
+             "'guided' (guided filter) or 'dt' (domain transform). Default is 'fgs'."
+    )
     # Argument for the simple gamma enhancement
     parser.add_argument(
         '--simple_gamma',
@@ -391,6 +788,20 @@ if __name__ == "__main__":
         default="15,80,250",
         help="Comma-separated sigma values for MSR scales. Default is '15,80,250'."
     )
+    parser.add_argument(
+        '--decode_scale',
+        type=int,
+        choices=sorted(DECODE_FLAGS),
+        default=1,
+        help="Decode the input maps downscaled by this factor (1, 2, 4 or 8). Default is 1 (full resolution)."
+    )
+    parser.add_argument(
+        '--device',
+        type=str,
+        choices=['cpu', 'cuda'],
+        default='cpu',
+        help="Run the pixel work on the CPU or on a CUDA GPU (requires CuPy). Default is 'cpu'."
+    )
     args = parser.parse_args()
 
     # --- DEPENDENCY CHECK ---
@@ -409,11 +820,17 @@ if __name__ == "__main__":
         print("2. `pip install opencv-contrib-python`")
         sys.exit(1)
 
+    if args.device == 'cuda' and cp is None:
+        print("\nError: 'cupy' library not found, which is required for --device cuda.")
+        print("Please install the build matching your CUDA version, e.g.: pip install cupy-cuda12x")
+        sys.exit(1)
+
     # --- RUN INFERENCE ---
     structured_params = {
         'lambda': args.lambda_val,
         'gamma': args.gamma,
-        'sigma': args.sigma
+        'sigma': args.sigma,
+        'smoother': args.smoother
     }
     
     # Parse tile grid size for CLAHE
@@ -435,6 +852,7 @@ if __name__ == "__main__":
         print("Error: Invalid format for --msr_sigmas. Please use comma-separated integers, e.g., '15,80,250'.")
         sys.exit(1)
     
-    run_inference(args.input_dir, args.output_dir, structured_params, args.brightness, args.simple_gamma, clahe_params, msr_sigmas)
+    run_inference(args.input_dir, args.output_dir, structured_params, args.brightness, args.simple_gamma, clahe_params, msr_sigmas,
+                  decode_scale=args.decode_scale, device=args.device)
 
 
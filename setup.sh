@@ -75,7 +75,7 @@ echo "✅ Intrinsic environment setup complete"
 echo "📚 Setting up enhancement environment..."
 conda activate enhancement_env
 
-pip install opencv-contrib-python numpy scipy scikit-image tqdm pathlib
+pip install opencv-contrib-python numpy scipy scikit-image tqdm numba pathlib
 
 conda deactivate
 echo "✅ Enhancement environment setup complete"